@@ -5,7 +5,7 @@ Aim of the script is to :
 -extract a json object from each snapshot, 
 -convert it into dataframe,
 -concatenate dataframes together into monthly batches
--save the monthly dataframes into separate .csv.gz files 
+-save the monthly dataframes into separate .parquet files 
 -and log possible errors in the process
 
 Resulting dataframes have following columns:
@@ -21,103 +21,195 @@ place_type - type of station
 bike_numbers - array of numbers of bikes available in given station and given time
 """
 
-import json
+import mmap
 import os
-import re
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from zipfile import ZipFile
 
 import pandas as pd
 from icecream import ic
-from joblib import Parallel, delayed
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 DATA_DIR = "/data/veturilo/"
 N_CORES = 6
+CHUNKSIZE = 64
 
 fname = os.path.join(DATA_DIR, "20190822.zip")
 
-
-def extract_timestamp(inner_fname):
-    """
-    Helper: Extract proper timestamp from filename
-    """
-    try:
-        dt = (
-            inner_fname[:4]
-            + "-"
-            + inner_fname[4:6]
-            + "-"
-            + inner_fname[6:8]
-            + " "
-            + inner_fname[9:11]
-            + ":"
-            + inner_fname[11:13]
-            + ":"
-            + inner_fname[13:15]
-        )
-    except:
-        dt = ""
-    return dt
+# columns available throughout whole time of data collection,
+# others would end up mostly empty after pd.concat
+EXPECTED_COLS = (
+    "uid",
+    "lat",
+    "lng",
+    "name",
+    "number",
+    "bikes",
+    "bike_racks",
+    "free_racks",
+    "place_type",
+    "bike_numbers",
+)
+
+# fixed (nullable, signed) dtypes, so that every month has the same schema
+NUMERIC_COLS = {
+    "bikes": "Int16",
+    "free_racks": "Int16",
+    "bike_racks": "Int16",
+    "number": "Int32",
+}
+CATEGORY_COLS = ("uid", "place_type", "name")
+
+_JSON_PREFIX = b"var NEXTBIKE_PLACES_DB = '"
+_JSON_SUFFIX = b"';"
 
 
 def list_months(data_dir=DATA_DIR):
     """
-    List all distinct months in the source directory
+    List all distinct months in the source directory along with their zip files.
+    The directory is scanned only once.
 
     :param data_dir: Source directory where zip files are stored
+
+    :return : dict of the form {month (YYYYMM): list of paths to zip files}, sorted by month
     """
-    all_files = [f[:6] for f in os.listdir(data_dir) if f.endswith(".zip")]
-    all_files = list(set(all_files))
-    all_files.sort()
-    return all_files
+    month_files = defaultdict(list)
+    with os.scandir(data_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith(".zip"):
+                month_files[entry.name[:6]].append(entry.path)
+    return {mth: sorted(month_files[mth]) for mth in sorted(month_files)}
 
 
-def process_month(mth, output_dir, data_dir):
+def process_month(mth, output_dir, files):
     """
     Extract data from all zips representing a month passed as first argument 
-    and store resulting dataframe in csv.gz in output_dir
+    and store resulting dataframe in parquet file in output_dir
 
     :param mth: Month to be processed in format YYYYMM
     :param output_dir: Where to store resulting DataFrame
-    :param data_dir: Where to look for zips
+    :param files: Paths to zips of given month, as listed by list_months()
 
     :return : no meaningful value is returned, data and processing log is written to output dir
     """
-    files = [
-        os.path.join(data_dir, f)
-        for f in os.listdir(data_dir)
-        if f.endswith(".zip") and f.startswith(mth)
-    ]
-    dfs = Parallel(N_CORES)(delayed(process_zip)(f) for f in files)
-    # dfs = [process_zip(f) for f in files]
-    data_df = pd.concat([df[0] for df in dfs])
-    processing_log = pd.concat([df[1] for df in dfs if df[1] is not None])
+    # snapshots (not whole zips) are the unit of work, so all cores stay busy
+    # regardless of how many zips the month has
+    zip_fnames, inner_fnames = [], []
+    for f in files:
+        f_inner_fnames = list_inner_files(f)
+        zip_fnames.extend([f] * len(f_inner_fnames))
+        inner_fnames.extend(f_inner_fnames)
+    with ProcessPoolExecutor(max_workers=N_CORES) as executor:
+        results = list(
+            executor.map(
+                inner_file_wrapper, zip_fnames, inner_fnames, chunksize=CHUNKSIZE
+            )
+        )
+    all_dfs, processing_log = collect_results(results)
+    data_df = pd.concat(all_dfs, copy=False, ignore_index=True)
+    data_df["dt"] = pd.to_datetime(
+        data_df["dt"], format="%Y%m%d%H%M%S", errors="coerce", cache=True
+    )
+    data_df = compact_dtypes(data_df)
     os.makedirs(output_dir, exist_ok=True)
-    data_df.to_csv(
-        os.path.join(output_dir, f"{mth}.csv.gz"), compression="gzip", index=False
+    data_df.to_parquet(
+        os.path.join(output_dir, f"{mth}.parquet"),
+        compression="zstd",
+        engine="pyarrow",
+        index=False,
     )
     processing_log.to_csv(os.path.join(output_dir, f"{mth}.log"), index=False)
     return True
 
 
-def extract_json(html_string):
+def compact_dtypes(df):
     """
-    Extract json from html content. The method is super simplistic using simple regex.
-    might need rethinking in the future.
+    Helper: Convert numeric columns to small integer types and repeated labels
+    to category, which makes the dataframe smaller in memory and on disk.
+    NOTE: there are some non-numeric values in source data (e.g. "5+" bikes),
+    these are stored as missing values, so the raw value is not kept in the output
 
-    :param html_string: raw HTML as it was saved using wget
+    :param df: Monthly dataframe as concatenated in process_month()
 
-    :return : JSON string extracted from HTML
+    :return : df with converted columns
     """
-    pattern = re.compile(r".*var NEXTBIKE_PLACES_DB = '(.*)';", re.M)
-    return pattern.findall(html_string)[0].replace("Gaulle\\'a", "Gaullea")
+    for c, dtype in NUMERIC_COLS.items():
+        if c in df.columns:
+            df[c] = pd.to_numeric(df[c], errors="coerce").astype(dtype)
+    for c in CATEGORY_COLS:
+        if c in df.columns:
+            df[c] = df[c].astype("category")
+    return df
 
 
-def inner_file_wrapper(zip_object, inner_fname):
+def list_inner_files(fname):
+    """
+    Helper: List snapshots stored in a zip file
+
+    :param fname: Path to zip file containing downloaded content
+    """
+    with ZipFile(fname) as zip_object:
+        return zip_object.namelist()
+
+
+class _MappedFile(mmap.mmap):
+    """
+    Helper: Read-only memory map usable as file object by ZipFile
+    (mmap has no seekable() before Python 3.13)
+    """
+
+    def seekable(self):
+        return True
+
+
+@lru_cache(maxsize=4)
+def _open_zip(fname):
+    """
+    Helper: Open a zip file once per process, so that its central directory
+    is not parsed again for every snapshot read from it.
+    The archive is memory-mapped, so all snapshots read from it share one mapping
+    instead of going through separate buffered reads.
+    """
+    with open(fname, "rb") as f:
+        zip_buffer = _MappedFile(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return ZipFile(zip_buffer)
+
+
+def extract_json(html_lines):
+    """
+    Extract json from html content. The method is super simplistic using plain substring
+    search. might need rethinking in the future.
+    The HTML is scanned line by line and scanning stops at the first match,
+    so the whole snapshot never has to be held in memory.
+    Lines are kept as bytes (no decoding) as the JSON parser accepts bytes directly.
+
+    :param html_lines: iterable of lines (bytes) of raw HTML as it was saved using wget
+
+    :return : JSON extracted from HTML (bytes)
+    """
+    for line in html_lines:
+        start = line.find(_JSON_PREFIX)
+        if start == -1:
+            continue
+        start += len(_JSON_PREFIX)
+        end = line.rfind(_JSON_SUFFIX, start)
+        if end != -1:
+            return line[start:end].replace(b"Gaulle\\'a", b"Gaullea")
+    raise ValueError("NEXTBIKE_PLACES_DB not found in HTML")
+
+
+def inner_file_wrapper(zip_fname, inner_fname):
     """
     Wrapper around extracting the json and creating a dataframe along with collecting 
-    possible errors. Handy when used together with list complrehension.
+    possible errors. Handy when used together with list complrehension or executor.map.
 
-    :param zip_object: Object as returned by ZipFile
+    :param zip_fname: Path to zip file containing downloaded content
     :param inner_fname: Name of file inside the archive
 
     :return: a tuple of the form: 
@@ -128,18 +220,18 @@ def inner_file_wrapper(zip_object, inner_fname):
     resulting DataFrame (if processing was successfull, None otherwise)
     """
 
-    dt = extract_timestamp(inner_fname)
-    html_string = zip_object.read(inner_fname).decode("utf-8")
-    try:
-        json_string = extract_json(html_string)
-    except Exception as err:
-        return (False, inner_fname, "extract_json", err)
+    # raw YYYYMMDDHHMMSS taken from the file name, parsed for the whole month in process_month()
+    dt = inner_fname[:8] + inner_fname[9:15]
+    with _open_zip(zip_fname).open(inner_fname) as html_lines:
+        try:
+            json_string = extract_json(html_lines)
+        except Exception as err:
+            return (False, inner_fname, "extract_json", err)
 
     try:
         df = process_json(json_string)
     except Exception as err:
         return (False, inner_fname, "process_json", err, None)
-    df = normalize_column_list(df)
     df["dt"] = dt
     return (True, inner_fname, None, None, df)
 
@@ -150,73 +242,63 @@ def process_zip(fname):
     
     :param fname: Path to zip file containing downloaded content
 
-    :return : A tuple of (resulting dataframe for given date, processing log)
+    :return : A tuple of (list of resulting dataframes for given date, processing log)
     Processing log has 3 columns: Name of input file (one single snapshot), stage when failure 
     happened and error message
-    Resulting dataframe has relevant data about situation at all accessible veturilo station 
+    Dataframes are not concatenated here so that process_month() can join the whole month 
+    in one go. Each of them has relevant data about situation at all accessible veturilo station 
     with columns:
     ["uid","lat","lng","name","number","bikes","bike_racks","free_racks","place_type",
     "bike_numbers"]
     """
-    zip_object = ZipFile(fname)
-    dfs_list = [inner_file_wrapper(zip_object, f) for f in zip_object.namelist()]
-    processing_log = pd.DataFrame(
-        [tpl[1:4] for tpl in dfs_list if not tpl[0]],
-        columns=["fname", "stage", "error"],
-    )
-    output_data = pd.concat([tpl[4] for tpl in dfs_list if tpl[0]])
-    return (output_data, processing_log)
+    dfs_list = [inner_file_wrapper(fname, f) for f in list_inner_files(fname)]
+    return collect_results(dfs_list)
 
 
-def normalize_column_list(
-    df,
-    expected_cols=[
-        "uid",
-        "lat",
-        "lng",
-        "name",
-        "number",
-        "bikes",
-        "bike_racks",
-        "free_racks",
-        "place_type",
-        "bike_numbers",
-    ],
-):
+def collect_results(dfs_list):
     """
-    Helper function to select from the data frame only the columns that were available throughout whole time of data collection.
-    It's convenient because otherwise pd.concat would create some mostly empty columns
+    Split results of inner_file_wrapper() into dataframes and processing log
 
-    :param df: Dataframe as returned in second element of the process_zip()
-    :param expected_cols: Columns expected to be present throughout whole data gathering process
+    :param dfs_list: List of tuples as returned by inner_file_wrapper()
 
-    :return : Column-wise subset of input df
+    :return : A tuple of (list of resulting dataframes, processing log)
     """
-    if len(expected_cols) == 0:
-        return df
-    existing_cols = set(df.columns.tolist()).intersection(set(expected_cols))
-    df = df[existing_cols]
-    return df
+    processing_log = pd.DataFrame(
+        [tpl[1:4] for tpl in dfs_list if not tpl[0]],
+        columns=["fname", "stage", "error"],
+    )
+    output_data = [tpl[4] for tpl in dfs_list if tpl[0]]
+    return (output_data, processing_log)
 
 
-def process_json(json_string, selected_region_name="VETURILO Poland"):
+def process_json(
+    json_string, selected_region_name="VETURILO Poland", columns=EXPECTED_COLS
+):
     """
     Converting extracted JSON into dataframe with information about veturilo system 
     (json object contains also other Polish Nextbike affiliates)
 
-    :param json_string: JSON extracted from downloaded html, as returned by extract_json()
+    :param json_string: JSON (str or bytes) extracted from downloaded html, as returned by extract_json()
     :param selected_region_name: self-explanatory
+    :param columns: Columns to be extracted, missing values are filled with None
 
     :return : Contents of json for given region name convertend into pd.DataFrame
     """
-    data = json.loads(json_string)
+    data = json_loads(json_string)
 
-    data = [i for i in data if i["region_info"]["name"] == selected_region_name][0]
-    extracted_df = pd.DataFrame.from_dict(data["places"])
+    data = next(
+        (i for i in data if i["region_info"]["name"] == selected_region_name), None
+    )
+    if data is None:
+        raise ValueError(f"Region {selected_region_name} not found in JSON")
+    places = data["places"]
+    # schema is known upfront, so columns are built directly from records
+    cols = {c: [p.get(c) for p in places] for c in columns}
+    extracted_df = pd.DataFrame(cols, copy=False)
     return extracted_df
 
 
 if __name__ == "__main__":
-    for m in list_months():
+    for m, files in list_months().items():
         ic(m)
-        process_month(m, "/data/veturilo/csv2", DATA_DIR)
+        process_month(m, "/data/veturilo/csv2", files)
@@ -3,7 +3,6 @@ Helper functions for analysing the data of Veturilo bike sharing system.
 Note: Functions are heavily context specific
 
 """
-import itertools
 import os
 import re
 
@@ -13,8 +12,19 @@ from icecream import ic
 DATA_DIR = "/data/veturilo/processed_csv/"
 
 
-def generate_fname(year, month, data_dir=DATA_DIR):
-    return f"{data_dir}/{year}{str(month).zfill(2)}.csv.gz"
+def generate_fname(year, month, data_dir=DATA_DIR, extension="parquet"):
+    return f"{data_dir}/{year}{str(month).zfill(2)}.{extension}"
+
+
+def find_fname(year, month, data_dir=DATA_DIR):
+    """
+    Helper: Name of monthly batch file for given year and month,
+    parquet if it exists, legacy csv.gz otherwise
+    """
+    fname = generate_fname(year, month, data_dir)
+    if not os.path.exists(fname):
+        fname = generate_fname(year, month, data_dir, extension="csv.gz")
+    return fname
 
 
 def list_files():
@@ -25,9 +35,9 @@ def read_data(fname=None, year=None, month=None):
     """
     Function to read monthly batch of data
 
-    :param fname: Name of csv.gz file to read data from
+    :param fname: Name of parquet (or legacy csv.gz) file to read data from
     :param year: if fname is not given it will be 
-    constructed based on year and month
+    constructed based on year and month (parquet file if it exists, csv.gz otherwise)
     :param month: if fname is not given it will be 
     constructed based on year and month
 
@@ -35,27 +45,34 @@ def read_data(fname=None, year=None, month=None):
     Collected columns are:
     """
     if fname is None and year is not None and month is not None:
-        fname = generate_fname(year, month)
+        fname = find_fname(year, month)
     elif type(fname) is int and year < 13:
-        fname = generate_fname(fname, year)
+        fname = find_fname(fname, year)
 
-    try:
-        df = pd.read_csv(fname, low_memory=False)
-    except FileNotFoundError:
+    if not os.path.exists(fname):
         fname = os.path.join(DATA_DIR, fname)
-        df = pd.read_csv(fname, low_memory=False)
 
-    df["bike_numbers"] = df["bike_numbers"].str.split(",")
+    if fname.endswith(".parquet"):
+        # dtypes are stored in parquet, no conversion needed apart from uid
+        # which may come back as category but is used as a plain label (e.g. uid == -1)
+        df = pd.read_parquet(fname)
+        if isinstance(df["uid"].dtype, pd.CategoricalDtype):
+            df["uid"] = df["uid"].astype(df["uid"].cat.categories.dtype)
+    else:
+        df = pd.read_csv(fname, low_memory=False)
 
-    df.loc[df["bike_numbers"].isnull(), "bike_numbers"] = pd.Series(
-        [[]] * df["bike_numbers"].isnull().sum()
-    ).values
+        df["dt"] = pd.to_datetime(df["dt"], format="%Y-%m-%d %H:%M:%S", cache=True)
 
-    df["dt"] = pd.to_datetime(df["dt"])
+        df["bikes"] = pd.to_numeric(df["bikes"], errors="coerce")
+        df["free_racks"] = pd.to_numeric(df["free_racks"], errors="coerce")
+        df["bike_racks"] = pd.to_numeric(df["bike_racks"], errors="coerce")
 
-    df["bikes"] = pd.to_numeric(df["bikes"], errors="coerce")
-    df["free_racks"] = pd.to_numeric(df["free_racks"], errors="coerce")
-    df["bike_racks"] = pd.to_numeric(df["bike_racks"], errors="coerce")
+    # stations without bikes are NaN in csv and "" in parquet, both become []
+    df["bike_numbers"] = pd.Series(
+        [v.split(",") if v else [] for v in df["bike_numbers"].fillna("")],
+        index=df.index,
+        dtype=object,
+    )
 
     if "Unnamed: 0" in df.columns:
         df = df.drop(columns=["Unnamed: 0"])
@@ -77,16 +94,14 @@ def bike_station_pairs(df):
     uid == -1 in returned dataframe denotes situation, that given bike 
     is not recorded at any existing station 
     """
-    pad_df = df[["uid", "dt"]].drop_duplicates()
     pairs_df = (
         df[["uid", "dt", "bike_numbers"]]
         .explode("bike_numbers")
         .rename(columns={"bike_numbers": "bike"})
     )
-    pad_df = pd.DataFrame(
-        itertools.product(pairs_df["dt"].unique(), pairs_df["bike"].unique()),
-        columns=["dt", "bike"],
-    )
+    pad_df = pd.MultiIndex.from_product(
+        [pairs_df["dt"].unique(), pairs_df["bike"].unique()], names=["dt", "bike"]
+    ).to_frame(index=False)
     pairs_df = pad_df.merge(pairs_df, on=["dt", "bike"], how="left")
     pairs_df["bike"] = pd.to_numeric(pairs_df["bike"], errors="coerce")
     pairs_df["uid"] = pairs_df["uid"].fillna(-1)
@@ -105,10 +120,11 @@ def _bike_station_pairs_virtual(df):
     TODO: merge it into one function with bike_station_pairs()
     """
 
-    df["len_bikes_array"] = df["bike_numbers"].apply(lambda x: len(x))
-    df.loc[df["len_bikes_array"] == 0, "bike_numbers"] = df.loc[
-        df["len_bikes_array"] == 0
-    ].apply(lambda x: -1 * x[df["len_bikes_array"] == 0].index)
+    df["len_bikes_array"] = df["bike_numbers"].str.len()
+    empty_idx = df.index[df["len_bikes_array"].eq(0)]
+    df.loc[empty_idx, "bike_numbers"] = pd.Series(
+        [[-i] for i in empty_idx], index=empty_idx, dtype=object
+    )
 
     pairs_df = (
         df[["uid", "dt", "bike_numbers"]]
@@ -120,12 +136,10 @@ def _bike_station_pairs_virtual(df):
     )  # there are some erroneus values in source data
     pairs_df = pairs_df[~pairs_df["bike"].isnull()]
 
-    pad_df = pd.DataFrame(
-        itertools.product(
-            pairs_df["dt"].unique(), pairs_df.loc[pairs_df["bike"] > 0, "bike"].unique()
-        ),
-        columns=["dt", "bike"],
-    )
+    pad_df = pd.MultiIndex.from_product(
+        [pairs_df["dt"].unique(), pairs_df.loc[pairs_df["bike"] > 0, "bike"].unique()],
+        names=["dt", "bike"],
+    ).to_frame(index=False)
     pairs_df = pad_df.merge(pairs_df, on=["dt", "bike"], how="outer")
     pairs_df["uid"] = pairs_df["uid"].fillna(-1)
     pairs_df = pairs_df.sort_values(["bike", "dt"])
@@ -173,6 +187,9 @@ def get_hourly_rentals_df(recompute=False, filename="hourly_rentals.pkl"):
     explicitly forced otherwise
 
     :param recompute: Should the data be computed
+
+    :return : pd.DataFrame as returned by prepare_hourly_rentals() for all months,
+    with uid as category (grouping by station is done many times downstream)
     """
     if recompute or not os.path.exists(filename):
         hourly_rentals = [
@@ -180,9 +197,9 @@ def get_hourly_rentals_df(recompute=False, filename="hourly_rentals.pkl"):
         ]
         hourly_rentals = pd.concat(hourly_rentals)
         hourly_rentals.to_pickle(filename)
-        return hourly_rentals
     else:
-        return pd.read_pickle(filename)
+        hourly_rentals = pd.read_pickle(filename)
+    return hourly_rentals.astype({"uid": "category"})
 
 
 def get_hourly_available_bikes(recompute=False, filename="hourly_available_bikes.pkl"):
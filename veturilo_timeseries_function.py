@@ -22,26 +22,16 @@ def add_rolling_sum_feature(df, max_h, min_h, rolsum_column="rent_count"):
     :return : Input df with added rolling sum column, 
     naming convention for the resulting column: [rolsum_column]_[max_h]_[min_h]
     """
-    max_df = (
-        df.groupby("uid")
-        .rolling(window=f"{max_h}H", on="dt")[rolsum_column]
-        .sum()
-        .reset_index()
-        .rename(columns={rolsum_column: "rol_max"})
-    )
-    min_df = (
-        df.groupby("uid")
-        .rolling(window=f"{min_h}H", on="dt")[rolsum_column]
-        .sum()
-        .reset_index()
-        .rename(columns={rolsum_column: "rol_min"})
-    )
-    tmp_df = max_df.merge(min_df, on=["uid", "dt"])
-    tmp_df[f"{rolsum_column}_{max_h}_{min_h}"] = tmp_df["rol_max"] - tmp_df["rol_min"]
-    df = df.merge(
-        tmp_df[["uid", "dt", f"{rolsum_column}_{max_h}_{min_h}"]],
-        how="left",
-        on=["uid", "dt"],
+    df = df.reset_index(drop=True)
+    sorted_df = df
+    if not pd.MultiIndex.from_frame(df[["uid", "dt"]]).is_monotonic_increasing:
+        sorted_df = df.sort_values(["uid", "dt"])
+    grouped = sorted_df.groupby("uid", observed=True)[["dt", rolsum_column]]
+    rol_max = grouped.rolling(window=f"{max_h}H", on="dt").sum()[rolsum_column]
+    rol_min = grouped.rolling(window=f"{min_h}H", on="dt").sum()[rolsum_column]
+    # results are indexed by (uid, original index), dropping uid aligns them with df
+    df[f"{rolsum_column}_{max_h}_{min_h}"] = (rol_max - rol_min).reset_index(
+        level=0, drop=True
     )
 
     return df
@@ -55,13 +45,20 @@ def extract_features(df, rolsum_column="rent_count"):
     and the column supplied as rolsum_column
     :param rolsum_column: Column for which rolling sums will be computed.
 
-    :return : dataframe df with computed features
+    :return : dataframe df with computed features, sorted by uid and dt
     """
-
-    df.loc[:, "month"] = df.loc[:, "dt"].dt.month
-    df.loc[:, "dayofweek"] = df.loc[:, "dt"].dt.dayofweek
-    df.loc[:, "hour"] = df.loc[:, "dt"].dt.hour
-    df.loc[:, "weeknum"] = df.loc[:, "dt"].dt.week
+    # sorted once here, so add_rolling_sum_feature() does not have to sort again
+    df = df.sort_values(["uid", "dt"])
+
+    # calendar attributes computed on the underlying datetime64 array
+    hours = df["dt"].values.astype("datetime64[h]").astype("int64")
+    days = hours // 24
+    months = df["dt"].values.astype("datetime64[M]").astype("int64")
+    df.loc[:, "month"] = (months % 12 + 1).astype("int8")
+    # 1970-01-01 was a Thursday, hence +3 to get Monday=0
+    df.loc[:, "dayofweek"] = ((days + 3) % 7).astype("int8")
+    df.loc[:, "hour"] = (hours % 24).astype("int8")
+    df.loc[:, "weeknum"] = df["dt"].dt.isocalendar().week.astype("int8")
     df = add_rolling_sum_feature(df, 48, 24, rolsum_column)
     df = add_rolling_sum_feature(df, 25, 24, rolsum_column)
     df = add_rolling_sum_feature(df, 7 * 24, 6 * 24, rolsum_column)
@@ -103,17 +100,16 @@ def predict_from_modeldirectory(
     NOTE: As it is only a PoC prediction are returned only for uid present in training data
     For production a fallback model must be created and used for missing uids
     """
-    output_dfs = []
-    for u in df["uid"].unique():
-        try:
-            tmp_df = df[df["uid"] == u].reset_index()
-            tmp_df.loc[:, destination_column] = model_directory[u].predict(
-                tmp_df[features_list]
-            )
-            output_dfs.append(tmp_df)
-        except KeyError:
-            pass
-    return pd.concat(output_dfs)
+    df = df[df["uid"].isin(model_directory.keys())].copy()
+    # predictions are placed by position, so duplicated index labels
+    # (e.g. after concatenating months) do not matter
+    features = df[features_list]
+    predictions = np.full(len(df), np.nan)
+    groups = df.groupby("uid", sort=False, observed=True).indices
+    for u, positions in groups.items():
+        predictions[positions] = model_directory[u].predict(features.iloc[positions])
+    df[destination_column] = predictions
+    return df
 
 
 def add_predictions(df, params_dict):
@@ -148,16 +144,21 @@ def aggregate_daily_predictions(
 ):
     """[summary]
     Aggregation hourly predictions to daily values and computing the difference between global and local prediction
-    NOTE: columns "global_prediction" and "local_prediction" are hardcoded but wrapped in try/catch
-    Not elegant but does the job
-    
+    NOTE: columns "global_prediction" and "local_prediction" are hardcoded,
+    the difference is computed only if both are present
+    Rows are returned in order of first appearance of (uid, D) in df, not sorted.
+    uid is expected as category (see veturilo_helper.get_hourly_rentals_df()),
+    only observed (uid, D) combinations are returned
+
     """
     agg_config = {col: "sum" for col in columns}
-    daily_counts = df.groupby(["uid", "D"]).agg(agg_config).reset_index()
-    try:
+    daily_counts = (
+        df.groupby(["uid", "D"], sort=False, observed=True)
+        .agg(agg_config)
+        .reset_index()
+    )
+    if {"global_prediction", "local_prediction"}.issubset(daily_counts.columns):
         daily_counts["unmet_demand"] = (
             daily_counts["global_prediction"] - daily_counts["local_prediction"]
         )
-    except KeyError:
-        pass
     return daily_counts